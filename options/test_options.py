@@ -1,36 +1,53 @@
 import flywheel
+import logging
 from pathlib import Path
+from types import SimpleNamespace
+import torch
 from options.base_options import BaseOptions  # BaseOptions is defined elsewhere
 from utils.parser import parse_config
 
-def get_gambas_basename(base, which_model):
+log = logging.getLogger(__name__)
+
+# Output suffix for each model
+_SUFFIX = {"GAMBAS": "_gambas.nii.gz", "ResCNN": "_ResCNN.nii.gz"}
+
+
+def get_gambas_basename(nii_name: str, which_model: str) -> str:
     """
-    Given an input directory and model name, returns a modified NIfTI basename
+    Given an input NIfTI filename and model name, returns a modified NIfTI basename
     with '_gambas' or '_ResCNN' inserted before the extension.
 
     Parameters:
-        in_dir (Path): Path to the input directory
-        which_model (str): 'GAMBAS' or other (e.g. 'ResCNN')
+        nii_name (str): Input NIfTI filename
+        which_model (str): 'GAMBAS' or 'ResCNN'
 
     Returns:
         str: Modified NIfTI filename
     """
-    
-    suffix = "_gambas.nii.gz" if which_model == 'GAMBAS' else "_ResCNN.nii.gz"
 
-    # Append '_gambas' before extension
-    if base.endswith(".nii.gz"):
-        gambas_basename = base.replace(".nii.gz", suffix)
-    else:
+    if not nii_name.endswith(".nii.gz"):
         raise ValueError("Unsupported file type")
 
-    print(f"Using {gambas_basename} as the output basename.")
+    gambas_basename = nii_name[:-len(".nii.gz")] + _SUFFIX[which_model]
+    log.debug("Using %s as the output basename.", gambas_basename)
     return gambas_basename
 
 
+def _resolve_paths(sub, ses, image, which_model):
+    """Return the input directory, output directory and output file for an input image."""
+    in_dir = Path(image).parent
+    output_path = Path(f"/flywheel/v0/work/derivatives/sub-{sub}/ses-{ses}/anat")
+    output_path.mkdir(parents=True, exist_ok=True)
+    result_sr = str(output_path / get_gambas_basename(Path(image).name, which_model))
+    return in_dir, output_path, result_sr
+
+
 class TestOptions(BaseOptions):
     def __init__(self, which_model, config, sub, ses, image):
         super().__init__()  # Initialize parent class
+        # The caller supplies the input file, so fail before any argparse work if it is missing
+        if not image:
+            raise ValueError("No input image provided")
         self.which_model = which_model  # Store which_model as an instance variable
         self.config = config
         self.sub = sub
@@ -42,9 +59,9 @@ class TestOptions(BaseOptions):
         parser = BaseOptions.initialize(self, parser)
         
         # Determine GPU setting based on model
-        gpu_index = '0' if which_model == 'GAMBAS' else '-1'
-        gpu_setting = 'gpu' if which_model == 'GAMBAS' else 'cpu'
-        netG = 'gambas' if which_model == 'GAMBAS' else 'res_cnn'
+        gpu_index = '0' if self.which_model == 'GAMBAS' else '-1'
+        gpu_setting = 'gpu' if self.which_model == 'GAMBAS' else 'cpu'
+        netG = 'gambas' if self.which_model == 'GAMBAS' else 'res_cnn'
 
 
 
@@ -53,20 +70,19 @@ class TestOptions(BaseOptions):
         parser.set_defaults(name=gpu_setting)
         parser.set_defaults(netG=netG)
 
-        in_dir = Path(f"/flywheel/v0/work/rawdata/sub-{self.sub}/ses-{self.ses}/anat")
-        output_path = Path(f"/flywheel/v0/work/derivatives/sub-{self.sub}/ses-{self.ses}/anat")
-        output_path.mkdir(parents=True, exist_ok=True)
-
-
-        m = self.which_model
-        output_label = get_gambas_basename(self.image, m)
+        # The caller already knows the input file, so derive the input directory
+        # from it rather than scanning the directory for NIfTI files.
+        # Keep the resolved paths on the instance so they are not recomputed
+        in_dir, output_path, self.result_sr = _resolve_paths(self.sub, self.ses, self.image, self.which_model)
+        self.in_dir = in_dir
+        self.output_path = output_path
         
         # Define default input and output directories
         parser.add_argument("--input_dir", type=str, default=in_dir, help="Path to input directory")
         parser.add_argument("--output_dir", type=str, default=output_path, help="Path to output directory")
         parser.add_argument("--image", type=str, default=self.image, help="Path to input NIfTI image")
         parser.add_argument("--reference", type=str, default="/flywheel/v0/app/TemplateKhula.nii", help="Path to reference NIfTI image")
-        parser.add_argument("--result_sr", type=str, default=str(Path(parser.get_default("output_dir")) / output_label), help="Path to save the result NIfTI file")
+        parser.add_argument("--result_sr", type=str, default=self.result_sr, help="Path to save the result NIfTI file")
         
         # Parse additional configuration arguments
         parser.add_argument("--phase", type=str, default=self.config.get("phase", "test"), help="Test phase")
@@ -79,3 +95,56 @@ class TestOptions(BaseOptions):
         self.isTrain = False
 
         return parser
+
+    @classmethod
+    def build(cls, which_model, config, sub, ses, image):
+        """
+        Build the test options programmatically, without argparse. Use parse() for the CLI.
+
+        Returns a SimpleNamespace with the fields read by the test model and by inference.
+        The defaults mirror BaseOptions.initialize, initialize() above and TestModel, so keep
+        them in sync when those change.
+        """
+        if not image:
+            raise ValueError("No input image provided")
+
+        is_gpu = which_model == 'GAMBAS'
+        in_dir, output_path, result_sr = _resolve_paths(sub, ses, image, which_model)
+
+        opt = SimpleNamespace(
+            # Input / output
+            input_dir=in_dir,
+            output_dir=output_path,
+            image=image,
+            reference="/flywheel/v0/app/TemplateKhula.nii",
+            result_sr=result_sr,
+            # Inference
+            phase=config.get("phase", "test"),
+            which_epoch=config.get("which_epoch", "latest"),
+            stride_inplane=int(config.get("stride_inplane", 32)),
+            stride_layer=int(config.get("stride_layer", 32)),
+            patch_size=[128, 128, 128],
+            resample=False,
+            new_resolution=(0.45, 0.45, 0.45),
+            # Model
+            model='test',
+            model_suffix='',
+            isTrain=False,
+            gpu_ids=[0] if is_gpu else [],
+            name='gpu' if is_gpu else 'cpu',
+            netG='gambas' if is_gpu else 'res_cnn',
+            checkpoints_dir='/flywheel/v0/app',
+            input_nc=1,
+            output_nc=1,
+            ngf=64,
+            norm='instance',
+            no_dropout=True,
+            init_type='normal',
+            init_gain=0.02,
+            verbose=False,
+        )
+
+        if len(opt.gpu_ids) > 0:
+            torch.cuda.set_device(opt.gpu_ids[0])
+
+        return opt
@@ -3,10 +3,14 @@
 import logging
 import os
 import sys
-import bids
 from datetime import datetime
-from io import StringIO
+from pathlib import Path
 import shutil
+import copy
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
 
 
 # import flywheel functions
@@ -16,17 +20,17 @@ import flywheel
 from utils.parser import parse_config
 from utils.parser import download_dataset
 from options.test_options import TestOptions
+from options.test_options import get_gambas_basename
 from models import create_model
 from app.main import inference
 from app.main import Registration
 import utils.bids as gb
 from utils.parser import parse_input_files
+from utils.parser import index_bids_dataset
 
 
 # Add top-level package directory to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-# Verify sys.path
-print("sys.path:", sys.path)
 os.environ["PATH"] += os.pathsep + "/opt/ants-2.5.4/bin"
 
 # The gear is split up into 2 main components. The run.py file which is executed
@@ -34,6 +38,7 @@ os.environ["PATH"] += os.pathsep + "/opt/ants-2.5.4/bin"
 # module.
 
 log = logging.getLogger(__name__)
+log.debug("sys.path: %s", sys.path)
 
 
 def main(context: GearToolkitContext) -> None:
@@ -41,7 +46,7 @@ def main(context: GearToolkitContext) -> None:
     Steps in main:
     1. Parse the config and other options from the context, both gear and app options.
     2. Download the dataset.
-    3. Initialize BIDS layout.
+    3. Index the BIDS dataset.
     4. Process each subject and create a new analysis container for each.
     5. Upload the output files to the analysis container.
     """
@@ -57,55 +62,90 @@ def main(context: GearToolkitContext) -> None:
     subses = download_dataset(context, input_container, config)
     print(f"subses: {subses}")
 
-    # Initialize BIDS layout
-    print('Step 3: Initializing BIDS layout')
-    layout = bids.BIDSLayout(root=f'{config["work_dir"]}/rawdata', derivatives=f'{config["work_dir"]}/derivatives')
+    # Index the BIDS dataset once; the table is reused for every subject/session
+    print('Step 3: Indexing BIDS dataset')
+    layout = index_bids_dataset(f'{config["work_dir"]}/rawdata')
     
     # Process each subject and create a new analysis container for each
     print('Step 4: Processing each subject')
-    for sub in subses.keys():
-            for ses in subses[sub].keys():
-                raw_fnames, deriv_fnames, logs = fw_process_subject(layout, sub, ses, which_model, config)
+    jobs = [(sub, ses) for sub in subses.keys() for ses in subses[sub].keys()]
+
+    # Gear details recorded on every analysis
+    gversion, gname, image = manifest["version"], manifest["name"], manifest["custom"]["gear-builder"]["image"]
+
+    if which_model == 'ResCNN' and len(jobs) > 1:
+        # The CPU model is CPU bound and sessions are independent, so run them in
+        # parallel and split the torch threads between the worker processes.
+        # Workers are forked so they inherit the gear context and the BIDS table.
+        # Each worker holds its own model, so the pool size is capped by config.
+        global _LAYOUT
+        _LAYOUT = layout
+        n_workers = max(1, min(int(config.get('max_workers', 2)), os.cpu_count(), len(jobs)))
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=torch.set_num_threads,
+                                 initargs=(max(1, os.cpu_count() // n_workers),)) as pool:
+            futures = [pool.submit(_process_job, sub, ses, which_model, config) for sub, ses in jobs]
+            results = [_job_result(future, sub, ses) for future, (sub, ses) in zip(futures, jobs)]
+    else:
+        # GAMBAS shares a single CUDA context, so sessions run one after another
+        results = (fw_process_subject(layout, sub, ses, which_model, config) for sub, ses in jobs)
+
+    # Outputs are uploaded from the main process
+    for (sub, ses), (raw_fnames, deriv_fnames, logs) in zip(jobs, results):
+        # Check for missing input or output
+        if not raw_fnames:
+            gb._logprint(f"[SKIPPING] No input files for {sub}/{ses}.")
+            continue
+        if not deriv_fnames:
+            gb._logprint(f"[ERROR] Processing failed for {sub}/{ses}: No derived output.")
+            # Delete files in raw_fnames because derived output is missing
+            for file_path in raw_fnames:
+                try:
+                    os.remove(file_path)
+                    gb._logprint(f"Deleted raw file: {file_path}")
+                except Exception as e:
+                    gb._logprint(f"Error deleting {file_path}: {e}")
+            continue
+
+        out_files = []
+        out_files.extend(raw_fnames)
+        out_files.extend(deriv_fnames)
+        out_files.extend(logs)
+
+        # Create a new analysis
+        gdate = datetime.now().strftime("%Y%m%d_%H:%M:%S")
+        session_container = context.client.get(subses[sub][ses])
         
-                # Check for missing input or output
-                if not raw_fnames:
-                    gb._logprint(f"[SKIPPING] No input files for {sub}/{ses}.")
-                    continue
-                if not deriv_fnames:
-                    gb._logprint(f"[ERROR] Processing failed for {sub}/{ses}: No derived output.")
-                    # Delete files in raw_fnames because derived output is missing
-                    for file_path in raw_fnames:
-                        try:
-                            os.remove(file_path)
-                            gb._logprint(f"Deleted raw file: {file_path}")
-                        except Exception as e:
-                            gb._logprint(f"Error deleting {file_path}: {e}")
-                    continue
-
-                out_files = []
-                out_files.extend(raw_fnames)
-                out_files.extend(deriv_fnames)
-                out_files.extend(logs)
-
-                # Create a new analysis
-                gversion = manifest["version"]
-                gname = manifest["name"]
-                gdate = datetime.now().strftime("%Y%M%d_%H:%M:%S")
-                image = manifest["custom"]["gear-builder"]["image"]
-                session_container = context.client.get(subses[sub][ses])
-                
-                analysis = session_container.add_analysis(label=f'{gname}/{gversion} {gdate}')
-                analysis.update_info({"gear":gname,
-                                    "version":gversion, 
-                                    "image":image,
-                                    "Date":gdate,
-                                    "status": "failed" if not deriv_fnames else "success",
-                                    "note": "No derived outputs, processing may have failed." if not deriv_fnames else "",
-                                    **config})
+        analysis = session_container.add_analysis(label=f'{gname}/{gversion} {gdate}')
+        analysis.update_info({"gear":gname,
+                            "version":gversion, 
+                            "image":image,
+                            "Date":gdate,
+                            "status": "failed" if not deriv_fnames else "success",
+                            "note": "No derived outputs, processing may have failed." if not deriv_fnames else "",
+                            **config})
+
+        for file in out_files:
+            gb._logprint(f"Uploading output file: {os.path.basename(file)}")
+            analysis.upload_output(file)
+
+
+# BIDS table shared with forked worker processes, so it is not pickled per job
+_LAYOUT = None
 
-                for file in out_files:
-                    gb._logprint(f"Uploading output file: {os.path.basename(file)}")
-                    analysis.upload_output(file)
+
+def _process_job(sub, ses, which_model, config):
+    """Worker entry point: process a session using the table inherited from the parent."""
+    return fw_process_subject(_LAYOUT, sub, ses, which_model, config)
+
+
+def _job_result(future, sub, ses):
+    """Return a worker's result, or empty outputs if the worker died (e.g. OOM-killed)."""
+    try:
+        return future.result()
+    except Exception as e:
+        gb._logprint(f"[ERROR] Worker failed for {sub}/{ses}: {e}")
+        return [], [], []
 
 
 # The main function for processing a subject
@@ -114,7 +154,7 @@ def fw_process_subject(layout, sub, ses, which_model, config):
     Run the model on the input files for a subject and session.
 
     Args:
-        layout (Layout): The BIDS Layout object.
+        layout (DataFrame): The bids2table index of the rawdata directory.
         sub (str): The subject ID.
         ses (str): The session ID.
         which_model (str): The model to use.
@@ -125,9 +165,9 @@ def fw_process_subject(layout, sub, ses, which_model, config):
         list: The list of derivative filenames.
     """
 
-    # Set up in-memory log capture for this subject
-    log_stream = StringIO()
-    handler = logging.StreamHandler(log_stream)
+    # Stream this subject's log straight to its log file
+    log_filename = os.path.join(gear_context.work_dir, f"sub-{sub}_ses-{ses}_log.txt")
+    handler = logging.FileHandler(log_filename, mode='w')
     handler.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
@@ -136,34 +176,40 @@ def fw_process_subject(layout, sub, ses, which_model, config):
     logger = logging.getLogger()
     logger.addHandler(handler)
     logs = []
+    raw_fnames, deriv_fnames = [], []
 
     try:
         logging.info(f"Processing subject {sub} session {ses}")
 
-        print('Parsing input files')
-        print(f"sub: {sub}, ses: {ses}")
-        
         my_files = parse_input_files(layout, sub, ses)
-        print(my_files)
+        log.debug("Input files: %s", my_files)
         
         gb._logprint(f'Starting for {sub}-{ses}')
 
 
-        all_t2 = [*my_files['axi'], *my_files['sag'], *my_files['cor']]
-
         deriv_fnames = []
-        raw_fnames = [x.path for x in all_t2]
+        raw_fnames = list(itertools.chain(my_files['axi'], my_files['sag'], my_files['cor']))
+
+        if raw_fnames:
+            # The model is the same for every file of this subject/session,
+            # so build the options and load the checkpoint only once
+            logging.info(f"Setting up options for model {which_model}")
+            base_opt = TestOptions.build(which_model=which_model, config=config, sub=sub, ses=ses, image=raw_fnames[0])
+
+            logging.info(f"Creating model for {sub}-{ses}")
+            model = create_model(base_opt)
+            model.setup(base_opt)
 
         for f in raw_fnames:
             try:
                 gb._logprint(f"Input file: {f}")
 
-                print('Setting up options for model')
-                logging.info(f"Setting up options for model {which_model}")
-                # Pass the current file to TestOptions if needed.
-                opt = TestOptions(which_model=which_model, config=config, sub=sub, ses=ses, image=f).parse()
+                # Only the input image and output path change per file, so copy the
+                # options instead of building them again
+                opt = copy.copy(base_opt)
+                opt.image = f
+                opt.result_sr = str(Path(base_opt.output_dir) / get_gambas_basename(Path(f).name, which_model))
                 
-                print('Registering images')
                 logging.info(f"Registering images for {sub}-{ses}")
                 input_image = Registration(opt.image, opt.reference, sub, ses)
                 
@@ -173,12 +219,6 @@ def fw_process_subject(layout, sub, ses, which_model, config):
                     logging.warning(f"Registration failed for subject {sub} session {ses}. Skipping this iteration.")
                     continue  # Skip to the next iteration if registration fails
 
-                print('Creating model')
-                logging.info(f"Creating model for {sub}-{ses}")
-                model = create_model(opt)
-                model.setup(opt)
-
-                print('Running inference')
                 logging.info(f"Running inference for {sub}-{ses}")
                 fname = inference(model, input_image, opt.result_sr, opt.resample, opt.new_resolution,
                                 opt.patch_size[0], opt.patch_size[1], opt.patch_size[2],
@@ -196,30 +236,14 @@ def fw_process_subject(layout, sub, ses, which_model, config):
                 logging.error(f"Error processing file {f} for subject {sub} session {ses}: {e}")
                 continue  # Continue with the next file
 
-            
-            if fname:
-                deriv_fnames.append(fname)
-                logging.info(f"Inference completed")
-                logging.info(f"Output file: {fname}")
-            else:
-                logging.error(f"Inference failed")
-                logging.error(f"No output file generated")
-
     except Exception as e:
         logging.error(f"Error processing subject {sub} session {ses}: {e}")
         # raise e
 
     finally:
-        # Write captured log to file
-        log_contents = log_stream.getvalue()
-        # log_filename = os.path.join(gear_context.output_dir, f"sub-{sub}_ses-{ses}_log.txt")
-        log_filename = os.path.join(gear_context.work_dir, f"sub-{sub}_ses-{ses}_log.txt")
-        with open(log_filename, 'w') as f:
-            f.write(log_contents)
-
         # Clean up
         logger.removeHandler(handler)
-        log_stream.close()
+        handler.close()
 
         # Append log filename to logs list
         logs.append(log_filename)
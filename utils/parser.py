@@ -8,34 +8,38 @@ import flywheel
 import json
 import os
 import subprocess
-from string import ascii_lowercase as alc
 import warnings
 from datetime import datetime
 import logging
+import functools
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from bids2table import bids2table
 
 from utils.bids import import_dicom_folder, setup_bids_directories
 
-def check_gpu():
-    """Check if the container has access to a GPU."""
-    try:
-        # Check if NVIDIA GPUs are available
-        result = subprocess.run(["nvidia-smi"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if result.returncode == 0:
-            print("GPU detected!")
-            return True
-        else:
-            print("No GPU detected.")
-            return False
-    except FileNotFoundError:
-        print("nvidia-smi not found. No GPU available.")
-        return False
+log = logging.getLogger(__name__)
 
+# Number of concurrent Flywheel file downloads
+DOWNLOAD_WORKERS = 16
 
-import os
-import subprocess
+# File names to download: contain 'T2' and 'axi' (any case), but none of the excluded words (any case)
+_ACCEPT = re.compile(r'(?=.*T2)(?=.*(?i:axi))(?!.*(?i:mapping|align|brain))')
 
+@functools.lru_cache(maxsize=None)
 def check_gpu():
     """Check if the container has access to a GPU."""
+    # Cheap probe first: the device node only exists when a GPU is passed through.
+    # (/proc/driver/nvidia is host procfs and is visible even without passthrough.)
+    if os.path.exists('/dev/nvidia0'):
+        print("GPU detected!")
+        return True
+
+    # Only fall back to forking nvidia-smi when CUDA_VISIBLE_DEVICES is unset
+    if 'CUDA_VISIBLE_DEVICES' in os.environ:
+        print("No GPU detected.")
+        return False
+
     try:
         # Check if NVIDIA GPUs are available
         result = subprocess.run(["nvidia-smi"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
@@ -50,6 +54,14 @@ def check_gpu():
         return False
 
 
+@functools.lru_cache(maxsize=None)
+def _load_json(path):
+    """Read and cache a JSON file (config.json / manifest.json) so it is only parsed once per run."""
+    with open(path) as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
 def parse_config(context):
     """Parse the config and other options from the context, both gear and app options.
 
@@ -81,16 +93,14 @@ def parse_config(context):
     # print(f"Container type: {container.container_type}")
 
     # Read config.json file
-    with open(base_dir + '/config.json') as f:
-        config = json.load(f)
+    config = _load_json(base_dir + '/config.json')
 
     # Read manifest.json file
-    with open(base_dir + '/manifest.json') as f:
-        manifest = json.load(f)
+    manifest = _load_json(base_dir + '/manifest.json')
     
     inputs = config['inputs']
     
-    config = config['config']
+    config = dict(config['config'])
     config['input_dir'] = input_dir
     config['work_dir'] = work_dir
     config['output_dir'] = output_dir
@@ -129,7 +139,7 @@ def download_dataset(gear_context: GearToolkitContext, container, config):
     # If this is the case should copy it to the same directory as the other files and then process as normal without going through the download process
 
     elif container.container_type == 'project':
-        proj_label, subjects = download_project(container, source_data_dir, force_run, dry_run=False)
+        proj_label, subjects = download_project(container, source_data_dir, force_run, dry_run=False, client=gear_context.client)
         print(f"Downlaoded project data, moving on to making BIDS structure...")
 
         output = {}
@@ -180,47 +190,59 @@ def make_project_label(proj) -> str:
     return proj.replace("-", '_').replace(" ", '')
 
 def download_file(file, my_dir, dry_run=False) -> str:
-    do_download = False
-
-    # Convert file name to lowercase for case-insensitive checks
-    file_name_lower = file.name.lower()
-
     # Check for required substrings and exclusions
-    if file['type'] in ['source code', 'nifti']:
-        if 'T2' in file.name and ('axi' in file_name_lower or 'AXI' in file.name):
-            if not any(excluded in file_name_lower for excluded in ['mapping', 'align', 'brain']): # 'diagnostic', 
-                do_download = True
-    
-    if do_download:
+    if file['type'] in ('source code', 'nifti') and _ACCEPT.match(file.name):
         download_dir = my_dir
         os.makedirs(download_dir, exist_ok=True)
         
         try:
             if dry_run:
-                print(f"[DRY RUN] Would have downloaded: {file.name}")
+                log.debug("[DRY RUN] Would have downloaded: %s", file.name)
             else:
-                fpath = os.path.join(download_dir, file.name)
+                fpath = f"{download_dir}/{file.name}"
                 if not os.path.exists(fpath):
                     file.download(fpath)
+                    log.debug("Downloaded file: %s", file.name)
                 else:
-                    print("File already downloaded")
+                    log.debug("File already downloaded: %s", file.name)
 
         except Exception as e:
-            print(f"Error downloading {file.name}: {e}")
-
-        print(f"Downloaded file: {file.name}")
+            log.error(f"Error downloading {file.name}: {e}")
 
     return file.name
 
 
-def download_session(ses_container, sub_dir, force_run, dry_run=False) -> Tuple[str, str]:
+def download_files(tasks, dry_run=False):
+    """Download a list of (file, dest_dir) pairs concurrently.
+
+    The downloads are I/O bound, so a thread pool is used. Files that already
+    exist on disk are skipped inside download_file. Tasks sharing a destination
+    path are dropped up front (first one wins) so two threads never write the
+    same file.
+    """
+    unique = {}
+    for file, dest_dir in tasks:
+        unique.setdefault(f"{dest_dir}/{file.name}", (file, dest_dir))
+    tasks = list(unique.values())
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        return list(pool.map(lambda t: download_file(*t, dry_run=dry_run), tasks))
+
+
+def download_session(ses_container, sub_dir, force_run, dry_run=False, tasks=None, acquisitions=None) -> Tuple[str, str]:
+    """Download a session. If a `tasks` list is given, the files are only queued on it
+    and the caller is responsible for calling download_files. `acquisitions` can be
+    passed when they were already fetched in bulk, to skip the per-session API call."""
+    if acquisitions is None:
+        acquisitions = ses_container.acquisitions()
+
     print("--- Downloading session ---")
     print(f"Session label: {ses_container.label}")
-    print(f"Acquisitions: {len(ses_container.acquisitions())}")
+    print(f"Acquisitions: {len(acquisitions)}")
     print(f"force_run: {force_run}")
 
     ses_label = make_session_label(ses_container)
-    ses_dir = os.path.join(sub_dir, ses_label)
+    ses_dir = f"{sub_dir}/{ses_label}"
     ses_id = ses_container.id
 
     proceed = True
@@ -239,41 +261,59 @@ def download_session(ses_container, sub_dir, force_run, dry_run=False) -> Tuple[
     #         proceed = True
 
     if proceed:
-        for acq in ses_container.acquisitions.iter():
+        queue = [] if tasks is None else tasks
+        for acq in acquisitions:
             for file in acq.files:
-                download_file(file, ses_dir, dry_run=dry_run)
+                queue.append((file, ses_dir))
+
+        if tasks is None:
+            download_files(queue, dry_run=dry_run)
 
     return ses_label, ses_dir, ses_id
 
 
-def download_subject(sub_container, proj_dir, force_run, dry_run=False):
+def download_subject(sub_container, proj_dir, force_run, dry_run=False, tasks=None, sessions=None, acquisitions=None):
+    """Download a subject. If a `tasks` list is given, the files are only queued on it
+    and the caller is responsible for calling download_files. `sessions` and
+    `acquisitions` (keyed by session id) can be passed when they were already
+    fetched in bulk, to skip the per-subject/per-session API calls."""
+    if sessions is None:
+        sessions = sub_container.sessions()
+
     print("--- Downloading subject ---")
     print(f"Label: {sub_container.label}")
-    print(f"Sessions: {len(sub_container.sessions())}")
+    print(f"Sessions: {len(sessions)}")
     
     sub_label = make_subject_label(sub_container)
-    sub_dir = os.path.join(proj_dir, sub_label)
+    sub_dir = f"{proj_dir}/{sub_label}"
     # print(f"Saving data into: {sub_dir}")
     
     sessions_out = {}
+    seen_counts = Counter()
+    queue = [] if tasks is None else tasks
 
-    for ses in sub_container.sessions.iter():
-        ses_label0, ses_dir, ses_id = download_session(ses, sub_dir, force_run, dry_run=dry_run)
+    for ses in sessions:
+        ses_acqs = None if acquisitions is None else acquisitions[ses.id]
+        ses_label0, ses_dir, ses_id = download_session(ses, sub_dir, force_run, dry_run=dry_run, tasks=queue, acquisitions=ses_acqs)
 
-        # Check for duplicate session labels
-        ses_label = ses_label0; i = 0
-        
+        # Check for duplicate session labels (digits only to stay BIDS compliant)
+        n = seen_counts[ses_label0]
+        ses_label = ses_label0 if n == 0 else f"{ses_label0}{n:03d}"
+        # A generated label can clash with a real one (e.g. X, X, X001), so keep going until unique
         while ses_label in sessions_out:
-            ses_label = ses_label0 + alc[i]
-            i += 1
-        
+            n += 1
+            ses_label = f"{ses_label0}{n:03d}"
+        seen_counts[ses_label0] = n + 1
 
         sessions_out[ses_label] = {'folder':ses_dir, 'id':ses_id}
 
+    if tasks is None:
+        download_files(queue, dry_run=dry_run)
+
     return sub_label, sessions_out
 
 
-def download_project(project, my_dir, force_run, dry_run=False):
+def download_project(project, my_dir, force_run, dry_run=False, client=None):
     print("--- Downloading project ---")
     print(f"Label: {project.label}")
     print(f"Subjects: {project.stats.number_of.subjects}")
@@ -281,40 +321,68 @@ def download_project(project, my_dir, force_run, dry_run=False):
     print(f"Acquisitions: {project.stats.number_of.acquisitions}")
     
     proj_name = make_project_label(project.label)
-    my_dir = os.path.join(my_dir, proj_name)
+    my_dir = f"{my_dir}/{proj_name}"
     # print(f"Saving data into: {my_dir}")
     
+    # Fetch the whole project hierarchy with one query per container level
+    # and group it client-side, instead of an API call per subject and session
+    client = client or flywheel.GearContext().client
+    query = f'parents.project={project.id}'
+
+    sessions = defaultdict(list)
+    for ses in client.sessions.iter_find(query):
+        sessions[ses.parents.subject].append(ses)
+
+    acquisitions = defaultdict(list)
+    for acq in client.acquisitions.iter_find(query):
+        acquisitions[acq.parents.session].append(acq)
+
+    # First pass collects the files to fetch, then they are downloaded in parallel
     subjects_out = {}
-    for sub in project.subjects.iter():
-        sub_lab, sessions_dict = download_subject(sub, my_dir, force_run, dry_run=dry_run)
+    tasks = []
+    for sub in client.subjects.iter_find(query):
+        sub_lab, sessions_dict = download_subject(sub, my_dir, force_run, dry_run=dry_run, tasks=tasks,
+                                                  sessions=sessions[sub.id], acquisitions=acquisitions)
         subjects_out[sub_lab] = sessions_dict
 
+    download_files(tasks, dry_run=dry_run)
+
     return proj_name, subjects_out
 
 
+def index_bids_dataset(root):
+    """Index a BIDS directory once with bids2table and return the flattened table.
+
+    The index is kept in memory only, so a stale index.b2t from an earlier run is never reused.
+
+    Columns follow the bids2table convention, e.g. 'ent__sub', 'ent__rec', 'finfo__file_path'.
+    """
+    tab = bids2table(root, workers=os.cpu_count(), persistent=False)
+    return tab.flat
+
+
 def parse_input_files(layout, sub, ses, show_summary=True):
     logger = logging.getLogger(__name__)
 
     try:
         # Example: Validate input layout
-        if not layout:
+        if layout is None or layout.empty:
             logger.error("No layout provided. Exiting parse_input_files.")
             raise ValueError("Empty layout provided")
         else:
             my_files = {'axi':[], 'sag':[], 'cor':[]}
 
+            # Single vectorised mask for this subject/session
+            t2w = layout[(layout['ent__sub'] == sub) & (layout['ent__ses'] == ses) &
+                         (layout['ent__suffix'] == 'T2w') & (layout['ent__ext'] == '.nii.gz')]
+
             for ax in my_files.keys():
-                files = layout.get(scope='raw', extension='.nii.gz', subject=sub, reconstruction=ax, session=ses)
+                files = t2w[t2w['ent__rec'] == ax].sort_values('ent__run')['finfo__file_path'].tolist()
                 
                 if ax == 'axi':
 
-                    if len(files)==2:
-                        axi1 = layout.get(scope='raw', extension='.nii.gz', subject=sub, reconstruction='axi', session=ses, run=1)[0]
-                        axi2 = layout.get(scope='raw', extension='.nii.gz', subject=sub, reconstruction='axi', session=ses, run=2)[0]
-                        my_files['axi'] = [axi1, axi2]
-
-                    elif len(files)==1:
-                        my_files['axi'] = layout.get(scope='raw', extension='.nii.gz', subject=sub, reconstruction='axi', session=ses)
+                    if len(files) in (1, 2):
+                        my_files['axi'] = files
                     
                     else:
                         warnings.warn(f'Expected to find 1 or 2 axial scans. Found {len(files)} axial scans')
@@ -345,8 +413,7 @@ def check_age(ses_id):
     ses = context.client.get(ses_id)
 
     # Read config.json file
-    p = open('/flywheel/v0/config.json')
-    config = json.loads(p.read())
+    config = _load_json('/flywheel/v0/config.json')
     # Read API key in config file
     api_key = (config['inputs']['api-key']['key'])
     fw = flywheel.Client(api_key=api_key)